@@ -1,24 +1,36 @@
 import argparse
-import json
+import binascii
 import os
+import random
 import re
 import time
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+# Requires: pip install requests lxml pyahocorasick orjson (ord-schema optional, for proto decoding)
+import ahocorasick
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import html as lxml_html, etree
 try:
     from ord_schema.proto import reaction_pb2
     HAS_ORD = True
 except Exception:
     HAS_ORD = False
-import base64
 
 
 BASE_URL = "https://open-reaction-database.org"
+SUMMARY_WORKERS = 8
 
+_TR_XPATH = etree.XPath(".//tr")
+_TD_TEXT_XPATH = etree.XPath("./td")
+_A_XPATH = etree.XPath(".//a")
 
-def _session():
+
+def _session(pool_size: int = 32):
     s = requests.Session()
     s.headers.update({
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122 Safari/537.36",
@@ -26,6 +38,20 @@ def _session():
         "Accept-Language": "en-US,en;q=0.9",
         "Referer": BASE_URL,
     })
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    # fetch_query_result handles 5xx itself, so only 429 is retried here.
+    poll_adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429]),
+    )
+    s.mount(f"{BASE_URL}/api/fetch_query_result", poll_adapter)
     return s
 
 
@@ -103,6 +129,40 @@ LIGAND_KEYWORDS = [
     "pcy3",
 ]
 
+_KEYWORD_AUTOMATON = ahocorasick.Automaton()
+for _cat, _keywords in (
+    ("Base", BASE_KEYWORDS),
+    ("amine", AMINE_KEYWORDS),
+    ("aryl halide", ARYL_HALIDE_KEYWORDS),
+    ("Metal", METAL_KEYWORDS),
+    ("Ligand", LIGAND_KEYWORDS),
+):
+    for _k in _keywords:
+        _k = _k.lower()
+        _KEYWORD_AUTOMATON.add_word(_k, _KEYWORD_AUTOMATON.get(_k, ()) + (_cat,))
+_KEYWORD_AUTOMATON.make_automaton()
+
+_ROW_LABELS = frozenset({"solvent", "reagent", "reactant", "ligand", "metal", "base"})
+_NUM_ONLY = re.compile(r"[0-9 .%]+")
+_SPLIT_SC = re.compile(r"[;,]\s*")
+_DATASET_ID = re.compile(r"ord_dataset-[A-Za-z0-9]+")
+_MKEY = re.compile(r"(?i)m\d+(?:_m\d+)*")
+# A value stops where the next label starts, so one pass sees every label.
+# Each label has its own group named after its category, since IGNORECASE also matches forms like "Baſe".
+_LAB_KV = re.compile(
+    r"(?:(?P<Base>base)|(?P<Solvent>solvent)|(?P<Ligand>ligand)|(?P<Metal>catalyst))\s*:\s*"
+    r"(?P<value>(?:(?!(?:base|solvent|ligand|catalyst)\s*:)[^\n\r<])+)",
+    re.IGNORECASE,
+)
+_LAB_CATS = ("Base", "Solvent", "Ligand", "Metal")
+_BASE_ION = re.compile(r"\[o-\].*\[(na|k|li)\+\]")
+_BASE_WORDS = re.compile(r"carbonate|hydroxide|hmds|otbu|tert-?butoxide")
+# Case-sensitive SMILES: a Cl/Br/I token bonded to an aromatic carbon, directly or after branches.
+_ARYL = re.compile(r"(?:Cl|Br|I)c|c\d*(?:\([^()]*\))*\(?(?:Cl|Br|I)(?![a-z])")
+_NH2 = re.compile(r"n[h]?2")
+
+RawHit = namedtuple("RawHit", ["reaction_id", "input_key", "reaction_role", "identifier_type", "value"])
+
 INPUT_KEY_CATEGORY_MAP = {
     "base": "Base",
     "solvent": "Solvent",
@@ -121,7 +181,7 @@ def list_datasets(s: requests.Session):
     u = f"{BASE_URL}/api/datasets"
     r = s.get(u, timeout=30)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
 def submit_query_for_dataset(s: requests.Session, dataset_id: str, limit: int):
@@ -133,17 +193,33 @@ def submit_query_for_dataset(s: requests.Session, dataset_id: str, limit: int):
     return tid
 
 
-def fetch_query_result(s: requests.Session, task_id: str, timeout_seconds: int = 120):
+def _retry_after(r: requests.Response):
+    try:
+        return max(0.0, float(r.headers.get("Retry-After", "")))
+    except ValueError:
+        return None
+
+
+def fetch_query_result(s: requests.Session, task_id: str, timeout_seconds: int = 120, max_transient: int = 3):
     u = f"{BASE_URL}/api/fetch_query_result"
     t0 = time.time()
-    delay = 0.5
+    delay = 0.2
+    transient = 0
     while True:
         r = s.get(u, params={"task_id": task_id}, timeout=30)
         if r.status_code == 200:
-            return r.json()
-        if r.status_code == 202:
-            time.sleep(delay)
-            delay = min(5.0, delay * 1.5)
+            return orjson.loads(r.content)
+        if r.status_code in (202, 500, 502, 503, 504):
+            if r.status_code != 202:
+                transient += 1
+                if transient > max_transient:
+                    raise RuntimeError(f"Status {r.status_code} for task {task_id} after {transient} attempts")
+            wait = _retry_after(r)
+            remaining = timeout_seconds - (time.time() - t0)
+            if remaining <= 0:
+                raise TimeoutError(f"Timeout waiting for task {task_id}")
+            time.sleep(min(wait if wait is not None else delay, remaining))
+            delay = min(5.0, delay * 1.5 + random.uniform(0, 0.2))
         elif r.status_code == 404:
             raise RuntimeError(f"Task {task_id} not found")
         else:
@@ -164,14 +240,18 @@ def _pick_name_from_cells(cells):
     for v in cells:
         if not v:
             continue
-        if re.fullmatch(r"[0-9 .%]+", v):
+        if _NUM_ONLY.fullmatch(v):
             continue
-        if v.lower() in ("reagent", "reactant", "solvent", "ligand", "metal", "base"):
+        if v.lower() in _ROW_LABELS:
             continue
         return v
     return None
 
 
+def _keyword_cats(v: str):
+    return {cat for _, cats in _KEYWORD_AUTOMATON.iter(v) for cat in cats}
+
+
 def _classify_from_text(name: str, label: str):
     lv = label.lower()
     nm = (name or "").lower()
@@ -184,157 +264,155 @@ def _classify_from_text(name: str, label: str):
     if lv == "base":
         return "Base"
     if lv in ("reagent", "reactant"):
-        if any(k in nm for k in BASE_KEYWORDS):
+        cats = _keyword_cats(nm)
+        if "Base" in cats:
             return "Base"
-        if any(k in nm for k in AMINE_KEYWORDS):
+        if "amine" in cats:
             return "amine"
-        if any(k in nm for k in LIGAND_KEYWORDS):
+        if "Ligand" in cats:
             return "Ligand"
-        if any(k in nm for k in METAL_KEYWORDS):
+        if "Metal" in cats:
             return "Metal"
-        if any(k in nm for k in ARYL_HALIDE_KEYWORDS) or ("br" in nm and "c" in nm) or ("cl" in nm and "c" in nm) or ("i" in nm and "c" in nm):
+        if "aryl halide" in cats or _ARYL.search(name or "") is not None:
             return "aryl halide"
     return None
 
 
 def extract_components(html: str):
-    soup = BeautifulSoup(html, "lxml")
     out = defaultdict(Counter)
-    for tr in soup.find_all("tr"):
-        cells = [td.get_text(strip=True) for td in tr.find_all("td")]
+    if not html or not html.strip():
+        return out
+    root = lxml_html.fromstring(html)
+    etree.strip_elements(root, etree.Comment, "script", "style", with_tail=False)
+    for tr in _TR_XPATH(root):
+        cells = ["".join(t.strip() for t in td.itertext()) for td in _TD_TEXT_XPATH(tr)]
         if not cells:
             continue
         label = None
-        for v in cells[::-1]:
-            lv = v.lower()
-            if lv in ("solvent", "reagent", "reactant", "ligand", "metal", "base"):
+        for v in reversed(cells):
+            if v.lower() in _ROW_LABELS:
                 label = v
                 break
         if not label:
             continue
         name = _pick_name_from_cells(cells[:-1])
         if not name:
-            link = tr.find("a")
-            name = link.get_text(strip=True) if link else None
+            links = _A_XPATH(tr)[:1]
+            name = "".join(t.strip() for t in links[0].itertext()) if links else None
         cat = _classify_from_text(name or "", label)
         if cat and name:
             out[cat][name] += 1
-    text = soup.get_text(" ", strip=True)
-    for lab, cat in [("Base", "Base"), ("Solvent", "Solvent"), ("Ligand", "Ligand"), ("Catalyst", "Metal")]:
-        for m in re.finditer(rf"{lab}\s*:\s*([^\n\r<]+)", text, flags=re.IGNORECASE):
-            raw = m.group(1)
-            parts = [p.strip() for p in re.split(r"[;,]\s*", raw) if p.strip()]
-            for p in parts:
+    text = " ".join(t.strip() for t in root.itertext() if t.strip())
+    for m in _LAB_KV.finditer(text):
+        cat = next(c for c in _LAB_CATS if m.group(c) is not None)
+        for p in _SPLIT_SC.split(m.group("value")):
+            p = p.strip()
+            if p:
                 out[cat][p] += 1
     return out
 
 
-def _enum_name(enum_cls, value: int):
-    try:
-        return enum_cls.Name(value)
-    except Exception:
-        return str(value)
-
-
-def _is_base_ident(value: str):
-    v = (value or "").lower()
-    if any(k in v for k in BASE_KEYWORDS):
-        return True
-    if re.search(r"\[o-\].*\[(na|k|li)\+\]", v):
-        return True
-    if re.search(r"(carbonate|hydroxide|hmds|otbu|tert-?butoxide)", v):
-        return True
-    return False
-
-
-def _is_amine_ident(value: str):
-    v = (value or "").lower()
-    if any(k in v for k in AMINE_KEYWORDS):
-        return True
-    if re.search(r"n[h]?2", v):
-        return True
-    return False
-
+if HAS_ORD:
+    _ROLE_NAME = {num: name for name, num in reaction_pb2.ReactionRole.ReactionRoleType.items()}
+    _IDT_NAME = {num: name for name, num in reaction_pb2.CompoundIdentifier.CompoundIdentifierType.items()}
 
-def _is_aryl_halide_ident(value: str):
-    v = (value or "").lower()
-    if any(k in v for k in ARYL_HALIDE_KEYWORDS):
-        return True
-    if re.search(r"c.*(cl|br|i)", v):
-        return True
-    return False
 
-
-def _is_metal_ident(value: str):
-    v = (value or "").lower()
-    if any(k in v for k in METAL_KEYWORDS):
-        return True
-    return False
+def _summary_components(s: requests.Session, reaction_id: str):
+    try:
+        return extract_components(get_reaction_summary_html(s, reaction_id))
+    except Exception:
+        return {}
 
 
-def _is_ligand_ident(value: str):
-    v = (value or "").lower()
-    if any(k in v for k in LIGAND_KEYWORDS):
-        return True
-    return False
+@lru_cache(maxsize=65536)
+def _classify_ident(value: str):
+    v = value.lower()
+    cats = _keyword_cats(v)
+    if "Base" not in cats and (_BASE_ION.search(v) or _BASE_WORDS.search(v)):
+        cats.add("Base")
+    if "amine" not in cats and _NH2.search(v):
+        cats.add("amine")
+    if "aryl halide" not in cats and _ARYL.search(value):
+        cats.add("aryl halide")
+    return frozenset(cats)
 
 
-def aggregate_dataset(s: requests.Session, dataset_id: str, per_dataset_limit: int):
+def aggregate_dataset(s: requests.Session, dataset_id: str, per_dataset_limit: int, smiles_only: bool = False, summary_executor: ThreadPoolExecutor = None):
     tid = submit_query_for_dataset(s, dataset_id, per_dataset_limit)
     items = fetch_query_result(s, tid)
     agg_counts = defaultdict(Counter)
     raw = defaultdict(list)
+    raw_get = raw.__getitem__
+    ac_get = agg_counts.__getitem__
+    rxn = reaction_pb2.Reaction() if HAS_ORD else None
+    html_rids = []
     for item in items:
         rid = item.get("reaction_id")
         if not rid:
             continue
         if HAS_ORD and item.get("proto"):
             try:
-                blob = base64.b64decode(item["proto"])
-                rxn = reaction_pb2.Reaction()
-                rxn.ParseFromString(blob)
+                blob = binascii.a2b_base64(item["proto"])
+                rxn.Clear()
+                rxn.MergeFromString(blob)
+                local_raw = defaultdict(list)
+                local_vals = defaultdict(list)
                 for k, inp in rxn.inputs.items():
                     for comp in inp.components:
                         role_num = getattr(comp, "reaction_role", 0)
-                        role_name = _enum_name(reaction_pb2.ReactionRole.ReactionRoleType, role_num) if isinstance(role_num, int) else None
-                        idents = []
-                        for ident in comp.identifiers:
-                            tname = _enum_name(reaction_pb2.CompoundIdentifier.CompoundIdentifierType, ident.type)
-                            idents.append({"type": tname, "value": ident.value})
+                        role_name = (_ROLE_NAME.get(role_num) or str(role_num)) if isinstance(role_num, int) else None
                         cat_by_key = INPUT_KEY_CATEGORY_MAP.get(k.lower())
-                        if not cat_by_key and re.fullmatch(r"(?i)m\d+(?:_m\d+)*", k):
+                        if not cat_by_key and _MKEY.fullmatch(k):
                             cat_by_key = k
                         if cat_by_key:
-                            for ident in idents:
-                                v = ident["value"]
-                                raw[cat_by_key].append({"reaction_id": rid, "input_key": k, "reaction_role": role_name, "identifier_type": ident["type"], "value": v})
-                                agg_counts[cat_by_key][v] += 1
+                            key_raw = local_raw[cat_by_key]
+                            key_vals = local_vals[cat_by_key]
+                            for ident in comp.identifiers:
+                                tname = _IDT_NAME.get(ident.type) or str(ident.type)
+                                if smiles_only and tname != "SMILES":
+                                    continue
+                                v = ident.value
+                                key_raw.append(RawHit(rid, k, role_name, tname, v))
+                                key_vals.append(v)
                         else:
-                            for ident in idents:
-                                v = ident["value"]
+                            for ident in comp.identifiers:
+                                tname = _IDT_NAME.get(ident.type) or str(ident.type)
+                                if smiles_only and tname != "SMILES":
+                                    continue
+                                v = ident.value
                                 if role_name == "SOLVENT":
-                                    raw["Solvent"].append({"reaction_id": rid, "input_key": k, "reaction_role": role_name, "identifier_type": ident["type"], "value": v})
-                                    agg_counts["Solvent"][v] += 1
+                                    cats = ("Solvent",)
                                 elif role_name in ("CATALYST",):
-                                    if _is_metal_ident(v):
-                                        raw["Metal"].append({"reaction_id": rid, "input_key": k, "reaction_role": role_name, "identifier_type": ident["type"], "value": v})
-                                        agg_counts["Metal"][v] += 1
-                                    if _is_ligand_ident(v):
-                                        raw["Ligand"].append({"reaction_id": rid, "input_key": k, "reaction_role": role_name, "identifier_type": ident["type"], "value": v})
-                                        agg_counts["Ligand"][v] += 1
+                                    cats = _classify_ident(v)
+                                    cats = [c for c in ("Metal", "Ligand") if c in cats]
                                 elif role_name in ("REAGENT", "REACTANT"):
-                                    if _is_base_ident(v):
-                                        raw["Base"].append({"reaction_id": rid, "input_key": k, "reaction_role": role_name, "identifier_type": ident["type"], "value": v})
-                                        agg_counts["Base"][v] += 1
-                                    if _is_amine_ident(v):
-                                        raw["amine"].append({"reaction_id": rid, "input_key": k, "reaction_role": role_name, "identifier_type": ident["type"], "value": v})
-                                        agg_counts["amine"][v] += 1
-                                    if _is_aryl_halide_ident(v):
-                                        raw["aryl halide"].append({"reaction_id": rid, "input_key": k, "reaction_role": role_name, "identifier_type": ident["type"], "value": v})
-                                        agg_counts["aryl halide"][v] += 1
+                                    cats = _classify_ident(v)
+                                    cats = [c for c in ("Base", "amine", "aryl halide") if c in cats]
+                                else:
+                                    continue
+                                if not cats:
+                                    continue
+                                entry = RawHit(rid, k, role_name, tname, v)
+                                for cat in cats:
+                                    local_raw[cat].append(entry)
+                                    local_vals[cat].append(v)
+                for cat, entries in local_raw.items():
+                    if entries:
+                        raw_get(cat).extend(entries)
+                        ac_get(cat).update(local_vals[cat])
             except Exception:
                 pass
-        time.sleep(0.1)
+        elif not smiles_only:
+            html_rids.append(rid)
+    if html_rids:
+        if summary_executor is None:
+            with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as ex:
+                summaries = list(ex.map(lambda rid: _summary_components(s, rid), html_rids))
+        else:
+            summaries = summary_executor.map(lambda rid: _summary_components(s, rid), html_rids)
+        for comps in summaries:
+            for cat, counter in comps.items():
+                ac_get(cat).update(counter)
     return {"counts": {k: dict(v) for k, v in agg_counts.items()}, "raw": {k: v for k, v in raw.items()}}
 
 
@@ -346,37 +424,37 @@ def main():
     ap.add_argument("--timeout", type=int, default=120, help="Timeout per server task")
     ap.add_argument("--base_only", action="store_true")
     ap.add_argument("--smiles_only", action="store_true")
+    ap.add_argument("--workers", type=int, default=8, help="Datasets scraped concurrently")
+    ap.add_argument("--summary_workers", type=int, default=SUMMARY_WORKERS, help="Reaction summary pages fetched concurrently across all datasets")
     ap.add_argument("dataset_urls", nargs="*")
     args = ap.parse_args()
-    s = _session()
+    # Every dataset thread and summary worker holds at most one connection at a time.
+    s = _session(pool_size=args.workers + args.summary_workers)
     all_datasets = list_datasets(s)
     ids_from_urls = []
     for u in args.dataset_urls:
-        m = re.search(r"ord_dataset-[A-Za-z0-9]+", u)
+        m = _DATASET_ID.search(u)
         if m:
             ids_from_urls.append(m.group(0))
     target_ids = [d["dataset_id"] for d in all_datasets] if not args.datasets and not ids_from_urls else (args.datasets + ids_from_urls)
     result = {}
-    for did in target_ids:
+    with ThreadPoolExecutor(max_workers=args.summary_workers) as summary_ex, ThreadPoolExecutor(max_workers=args.workers) as ex:
+        futures = [(did, ex.submit(aggregate_dataset, s, did, args.limit, args.smiles_only, summary_ex)) for did in target_ids]
+    for did, fut in futures:
         try:
-            data = aggregate_dataset(s, did, args.limit)
+            data = fut.result()
             if data:
                 if args.base_only:
-                    base_raw = [x for x in data["raw"].get("Base", []) if (not args.smiles_only or x.get("identifier_type") == "SMILES")]
+                    base_raw = data["raw"].get("Base", [])
                     base_counts = data["counts"].get("Base", {})
-                    result[did] = {"counts": {"Base": base_counts}, "raw": {"Base": base_raw}}
+                    result[did] = {"counts": {"Base": base_counts}, "raw": {"Base": [x._asdict() for x in base_raw]}}
                 else:
-                    if args.smiles_only:
-                        filtered_raw = {}
-                        for k, lst in data["raw"].items():
-                            filtered_raw[k] = [x for x in lst if x.get("identifier_type") == "SMILES"]
-                        data["raw"] = filtered_raw
+                    data["raw"] = {k: [x._asdict() for x in lst] for k, lst in data["raw"].items()}
                     result[did] = data
         except Exception as e:
             continue
-    tmp = json.dumps(result, ensure_ascii=False, indent=2)
-    with open(args.out, "w", encoding="utf-8") as f:
-        f.write(tmp)
+    with open(args.out, "wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
     print(args.out)
 
 